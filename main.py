@@ -1,12 +1,44 @@
 # main.py
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Query, BackgroundTasks
+from fastapi.responses import JSONResponse, Response
+from contextlib import asynccontextmanager
 from utils.storage import get_storage
-from PIL import Image
-import io, uuid, os
-from urllib.parse import urljoin
+from utils import admission, metrics
+from utils.warmup import Warmup
+from utils.ledger import JobLedger, issue_owner_token, owner_from_token
+from utils.admission import AdmissionScheduler, Overloaded, Ticket
+from staging.image_io import HandleCache, default_cache_bytes
+from staging.http_client import close_client
+from staging.cutouts import SLOTS, CutoutLibrary
+from typing import List, Optional, Tuple
+import asyncio, json, uuid, os
+from urllib.parse import urljoin, quote
 
-app = FastAPI()
 storage = get_storage()
+warmup = Warmup(storage)
+# Opened in lifespan: importing main must not create files or start threads
+ledger: Optional[JobLedger] = None
+# Tier-aware admission in front of the staging pipeline (scarce model concurrency)
+scheduler = AdmissionScheduler()
+# Pre-generated furniture cutouts for the local compositing mode (no model call)
+cutouts = CutoutLibrary(storage)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ledger
+    ledger = JobLedger()
+    # Warm up in the background: the port opens right away, /ready flips when done
+    task = asyncio.create_task(warmup.run())
+    yield
+    task.cancel()
+    await close_client()
+    ledger.close()
+
+app = FastAPI(lifespan=lifespan)
+# Largest change boxes sent in X-Change-Regions (~25 bytes each); proxies cap header size
+MAX_HEADER_REGIONS = int(os.environ.get("INSTASTAGE_MAX_HEADER_REGIONS", "32"))
+# Recent originals for iterative restyling: small ones decoded, large ones as JPEG only
+originals_cache = HandleCache(default_cache_bytes())
 
 def make_public_url(request: Request, url_or_path: str) -> str:
     """
@@ -28,51 +60,455 @@ def make_public_url(request: Request, url_or_path: str) -> str:
     path = url_or_path[1:] if url_or_path.startswith("/") else url_or_path
     return urljoin(base, path)
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once startup warm-up has finished, 503 before."""
+    body = {"ready": warmup.ready, "warmup": warmup.status}
+    return JSONResponse(body, status_code=200 if warmup.ready else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Process-local counters/timers (hedges, deadline hits, model-call latency, queue wait per tier)."""
+    return {**metrics.snapshot(), "admission": scheduler.snapshot()}
+
+def parse_styles(values: List[str]) -> List[str]:
+    """
+    Accepts repeated `furniture_style` fields and/or comma-separated values.
+    Returns unique styles in request order.
+    """
+    styles: List[str] = []
+    for v in values:
+        for s in v.split(","):
+            s = s.strip()
+            if s and s not in styles:
+                styles.append(s)
+    return styles
+
+def validate_styles(furniture_style: List[str]) -> List[str]:
+    styles = parse_styles(furniture_style)
+    max_styles = int(os.environ.get("INSTASTAGE_MAX_STYLES", "4"))
+    if not styles:
+        raise HTTPException(status_code=400, detail="furniture_style is required")
+    if len(styles) > max_styles:
+        raise HTTPException(status_code=400, detail=f"At most {max_styles} furniture styles per request")
+    return styles
+
+def staged_key_for(job_id: str, styles: List[str], style: str, rev: Optional[str] = None) -> str:
+    parts = [job_id]
+    if rev:
+        parts.append(rev)
+    if len(styles) > 1:
+        parts.append(str(styles.index(style)))
+    return f"staged/{'_'.join(parts)}_staged.jpg"
+
+async def admit(tier: str, cost: int = 1) -> Ticket:
+    """
+    Wait for `cost` staging slots (one per concurrent model call); a full tier queue
+    is shed right away with 503 + Retry-After.
+    """
+    try:
+        ticket = await scheduler.acquire(tier, cost)
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Staging is at capacity, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    admission.bind(scheduler, ticket)  # hedged model calls borrow extra slots against it
+    return ticket
+
+def resolve_mode(mode: Optional[str], tier: str) -> Tuple[str, bool]:
+    """
+    'edit' (full-scene model edit), 'composite' (local compositing from cached cutouts)
+    or 'auto' (composite for the free tier, edit for paid). Default: INSTASTAGE_PIPELINE_MODE.
+    Returns (mode, may_fall_back): only 'auto' may turn a composite into a paid edit.
+    """
+    m = (mode or os.environ.get("INSTASTAGE_PIPELINE_MODE", "edit")).strip().lower()
+    if m not in ("edit", "composite", "auto"):
+        raise HTTPException(status_code=400, detail="mode must be 'edit', 'composite' or 'auto'")
+    if m == "auto":
+        return ("composite" if scheduler.tier_for(tier) == "free" else "edit"), True
+    return m, False
+
+async def plan_run(room_type: str, styles: List[str], tier: str, mode: Optional[str]):
+    """
+    Returns (cutout_sets, ticket). Compositing mode needs a cutout set for every style
+    and takes no model slot; otherwise the job is admitted for a model edit, one slot
+    per style. A missing set falls back to an edit only in 'auto' mode; an explicit
+    composite answers 409 instead. Generating missing cutout sets (if enabled)
+    holds one slot per concurrent paid image call while it runs.
+    """
+    resolved, may_fall_back = resolve_mode(mode, tier)
+    if resolved == "composite":
+        sets, missing = {}, []
+        for s in styles:
+            pieces = await cutouts.get(room_type, s, generate=False)
+            if pieces is None:
+                missing.append(s)
+            else:
+                sets[s] = pieces
+        if missing and cutouts.generate_on_miss:
+            # Sets are built one style at a time, each with one paid image call per slot
+            ticket = await admit(tier, cost=len(SLOTS))
+            try:
+                for s in missing:
+                    sets[s] = await cutouts.get(room_type, s, generate=True)
+            finally:
+                scheduler.release(ticket)
+            missing = []
+        if not missing:
+            return sets, None
+        if not may_fall_back:
+            raise HTTPException(
+                status_code=409,
+                detail=f"No furniture cutouts for {', '.join(missing)} yet; use mode=edit or auto",
+            )
+    return None, await admit(tier, cost=len(styles))
+
+def owner_for(request: Request) -> Tuple[str, str]:
+    """
+    (ledger owner, history token). The owner is server-issued: a valid X-History-Token
+    header names it, otherwise a new owner and token are minted. The app keeps the
+    token from the first response and sends it on later requests and to GET /jobs.
+    """
+    token = request.headers.get("x-history-token")
+    owner = owner_from_token(token)
+    if owner is None:
+        owner, token = issue_owner_token()
+    return owner, token
+
+def require_owner(request: Request) -> Tuple[str, str]:
+    """(owner, history token) for endpoints that read existing jobs; 401 without a valid token."""
+    token = request.headers.get("x-history-token")
+    owner = owner_from_token(token)
+    if owner is None:
+        raise HTTPException(status_code=401, detail="A valid X-History-Token is required")
+    return owner, token.strip()
+
+async def stage_variants(
+    request: Request,
+    src,
+    job_id: str,
+    room_type: str,
+    styles: List[str],
+    inplace: bool,
+    rev: Optional[str] = None,
+    cutout_sets: Optional[dict] = None,
+    original_url: Optional[str] = None,
+    concurrency: Optional[int] = None,
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Run staging pipeline once per style, sharing the decoded original and model input.
+    Each variant is encoded and stored as it completes (with inplace=True the last may be
+    composited into src.image). Returns ([{furniture_style, staged_url, regions}],
+    [{furniture_style, staged_key}]) in request order; regions are the changed boxes
+    ([{box: [x0, y0, x1, y1], area}]) for the app's before/after slider, None when composited.
+    With cutout_sets the styles are composited locally instead of edited by the model.
+    `concurrency` caps the model edits in flight (the admission slots held).
+    A style that fails gets staged_url None and an `error`, and no key; the others
+    still finish. Raises only if every style failed.
+    """
+    from staging.pipeline import encode_jpeg, stage_styles_async
+
+    floor_y_frac = None
+    if cutout_sets is not None and original_url and os.environ.get("INSTASTAGE_COMPOSITE_ANALYZE", "0") == "1":
+        # Optional: a cheap vision call for the floor line; compositor default otherwise
+        from staging.analyzer_openai import analyze_room_with_openai
+        analysis = await analyze_room_with_openai(original_url)
+        floor_y_frac = analysis["floor_y_frac"] if analysis else None
+
+    staged_urls, staged_keys, staged_regions, errors = {}, {}, {}, {}
+    async for style, staged_pil, regions in stage_styles_async(
+        src, room_type, styles, inplace=inplace, cutouts=cutout_sets, floor_y_frac=floor_y_frac,
+        return_exceptions=True, concurrency=concurrency,
+    ):
+        if isinstance(staged_pil, Exception):
+            errors[style] = staged_pil
+            metrics.incr("stage.style_errors")
+            continue
+        staged_bytes = await asyncio.to_thread(encode_jpeg, staged_pil, 95, src.icc_profile)
+        del staged_pil
+        staged_regions[style] = regions
+
+        staged_key = staged_key_for(job_id, styles, style, rev)
+        try:
+            staged_urls[style] = await asyncio.to_thread(storage.save_bytes, staged_key, staged_bytes, "image/jpeg")
+        except Exception as e:
+            errors[style] = e
+            metrics.incr("stage.style_errors")
+            continue
+        finally:
+            del staged_bytes
+        staged_keys[style] = staged_key
+
+    if len(errors) == len(styles):
+        raise errors[styles[0]]
+
+    # Force absolute, public URLs for mobile clients
+    variants = []
+    for s in styles:
+        if s in errors:
+            variants.append({"furniture_style": s, "staged_url": None, "regions": None,
+                             "error": f"AI staging failed: {errors[s]}"})
+        else:
+            variants.append({"furniture_style": s, "staged_url": make_public_url(request, staged_urls[s]),
+                             "regions": staged_regions[s]})
+    keys = [{"furniture_style": s, "staged_key": staged_keys[s]} for s in styles if s in staged_keys]
+    return variants, keys
+
+def validate_response_mode(response: Optional[str], styles: List[str]) -> bool:
+    """True for response=inline (staged JPEG in the body); 'json' (default) returns URLs."""
+    r = (response or "json").strip().lower()
+    if r not in ("json", "inline"):
+        raise HTTPException(status_code=400, detail="response must be 'json' or 'inline'")
+    if r == "inline" and len(styles) > 1:
+        raise HTTPException(status_code=400, detail="response=inline supports a single furniture_style")
+    return r == "inline"
+
+def persist_staged(
+    staged_key: str,
+    staged_bytes: bytes,
+    job_id: str,
+    owner: str,
+    kind: str,
+    room_type: str,
+    tier: str,
+    orig_key: str,
+    style: str,
+) -> None:
+    """Background half of response=inline: store the staged image, then record the job."""
+    try:
+        storage.save_bytes(staged_key, staged_bytes, "image/jpeg")
+    except Exception:
+        metrics.incr("inline.persist_errors")
+        raise
+    ledger.record(job_id, owner, kind, room_type, tier, orig_key,
+                  [{"furniture_style": style, "staged_key": staged_key}])
+
+async def stage_inline(
+    request: Request,
+    background: BackgroundTasks,
+    src,
+    job_id: str,
+    kind: str,
+    room_type: str,
+    style: str,
+    tier: str,
+    owner: str,
+    history_token: str,
+    orig_key: str,
+    original_url: str,
+    inplace: bool,
+    rev: Optional[str] = None,
+    cutout_sets: Optional[dict] = None,
+) -> Response:
+    """
+    Stage one style and return the encoded JPEG as the response body, job metadata in
+    X-* headers. Storage writes and the ledger row happen after the response is sent;
+    the URLs in the headers resolve once they land.
+    """
+    from staging.pipeline import encode_jpeg, stage_styles_async
+
+    regions = None
+    async for _, staged_pil, regions in stage_styles_async(src, room_type, [style], inplace=inplace, cutouts=cutout_sets):
+        staged_bytes = await asyncio.to_thread(encode_jpeg, staged_pil, 95, src.icc_profile)
+        del staged_pil
+
+    staged_key = staged_key_for(job_id, [style], style, rev)
+    background.add_task(
+        persist_staged, staged_key, staged_bytes, job_id, owner, kind, room_type, tier, orig_key, style,
+    )
+    headers = {
+        "X-Job-Id": job_id,
+        "X-Room-Type": quote(room_type),
+        "X-Furniture-Style": quote(style),
+        "X-Tier": quote(tier),
+        "X-Mode": "edit" if cutout_sets is None else "composite",
+        "X-Original-Url": original_url,
+        "X-Staged-Url": make_public_url(request, storage.url_for(staged_key)),
+        "X-History-Token": history_token,
+    }
+    if regions is not None:
+        # Regions come largest first, so the cap keeps the ones the slider cares about
+        boxes = [r["box"] for r in regions[:MAX_HEADER_REGIONS]]
+        headers["X-Change-Regions"] = json.dumps(boxes, separators=(",", ":"))
+        headers["X-Change-Regions-Total"] = str(len(regions))
+    return Response(content=staged_bytes, media_type="image/jpeg", headers=headers)
+
 @app.post("/stage")
 async def stage(
     request: Request,
+    background: BackgroundTasks,
     image: UploadFile = File(...),
     room_type: str = Form(...),
-    furniture_style: str = Form(...),
+    furniture_style: List[str] = Form(...),
     tier: str = Form(...),
+    mode: Optional[str] = Form(None),
+    response: Optional[str] = Form(None),
 ):
+    styles = validate_styles(furniture_style)
+    inline = validate_response_mode(response, styles)
+    owner, history_token = owner_for(request)
+    cutout_sets, ticket = await plan_run(room_type, styles, tier, mode)
+
     try:
         raw = await image.read()
 
         # Save original (normalize to high-quality JPEG)
         job_id = str(uuid.uuid4())
         orig_key = f"originals/{job_id}.jpg"
+        ledger.claim(job_id, owner)  # restage checks ownership before the row lands
 
-        img = Image.open(io.BytesIO(raw)).convert("RGB")
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=95, optimize=True)
-        orig_bytes = buf.getvalue()
+        # Decode at most once; an upright JPEG upload is stored as-is (metadata stripped)
+        from staging.pipeline import ImageHandle
+        src = ImageHandle.from_bytes(raw)
+        del raw
+        orig_bytes = await asyncio.to_thread(src.jpeg, 95)
 
-        original_url_raw = storage.save_bytes(orig_key, orig_bytes, "image/jpeg")
+        if inline:
+            # Stored after the response goes out (tasks run in order: original, then staged)
+            background.add_task(storage.save_bytes, orig_key, orig_bytes, "image/jpeg")
+            original_url_raw = storage.url_for(orig_key)
+        else:
+            original_url_raw = await asyncio.to_thread(storage.save_bytes, orig_key, orig_bytes, "image/jpeg")
+        del orig_bytes
 
-        # Run staging pipeline -> returns a PIL.Image
-        from staging.pipeline import stage_image_async
-        staged_pil = await stage_image_async(img, room_type, furniture_style, None)
+        # Keep the original around for /jobs/{job_id}/restage. Shared (decoded, cached)
+        # handles must not be composited into, so only unshared ones allow inplace.
+        cached = originals_cache.put(job_id, src)
+        original_url = make_public_url(request, original_url_raw)
+        if inline:
+            return await stage_inline(
+                request, background, src, job_id, "stage", room_type, styles[0], tier,
+                owner, history_token, orig_key, original_url, inplace=not cached,
+                cutout_sets=cutout_sets,
+            )
+        variants, keys = await stage_variants(
+            request, src, job_id, room_type, styles, inplace=not cached,
+            cutout_sets=cutout_sets, original_url=original_url,
+            concurrency=ticket.cost if ticket is not None else None,
+        )
+        del src
 
-        # Encode staged -> JPEG and store
-        sbuf = io.BytesIO()
-        staged_pil.save(sbuf, format="JPEG", quality=95, optimize=True)
-        staged_bytes = sbuf.getvalue()
+        # History row (queued; written off the request path)
+        ledger.record(job_id, owner, "stage", room_type, tier, orig_key, keys)
 
-        staged_key = f"staged/{job_id}_staged.jpg"
-        staged_url_raw = storage.save_bytes(staged_key, staged_bytes, "image/jpeg")
+        return {
+            "job_id": job_id,
+            "room_type": room_type,
+            "furniture_style": styles[0],
+            "tier": tier,
+            "mode": "edit" if cutout_sets is None else "composite",
+            "original_url": original_url,
+            "staged_url": next(v["staged_url"] for v in variants if v["staged_url"]),
+            "variants": variants,
+            "history_token": history_token,
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI staging failed: {e}")
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
 
-        # Force absolute, public URLs for mobile clients
-        original_url = make_public_url(request, original_url_raw)
-        staged_url = make_public_url(request, staged_url_raw)
+@app.post("/jobs/{job_id}/restage")
+async def restage(
+    request: Request,
+    background: BackgroundTasks,
+    job_id: str,
+    room_type: str = Form(...),
+    furniture_style: List[str] = Form(...),
+    tier: str = Form(...),
+    mode: Optional[str] = Form(None),
+    response: Optional[str] = Form(None),
+):
+    """
+    Stage a previously uploaded original again (new room/style) without re-uploading it.
+    Recently used originals are served from memory (decoded, or as JPEG if large);
+    otherwise the stored JPEG is loaded and reused as the model input as-is.
+    Only the job's owner (X-History-Token) may restage it; other jobs are 404.
+    """
+    styles = validate_styles(furniture_style)
+    inline = validate_response_mode(response, styles)
+    owner, history_token = require_owner(request)
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if await asyncio.to_thread(ledger.owner_of, job_id) != owner:
+        raise HTTPException(status_code=404, detail="Job not found")
+    orig_key = f"originals/{job_id}.jpg"
+
+    from staging.pipeline import ImageHandle
+    src = originals_cache.get(job_id)
+    cached = src is not None and originals_cache.shares(src)
+    if src is None:
+        try:
+            data = await asyncio.to_thread(storage.load_bytes, orig_key)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Job not found")
+        src = ImageHandle.from_bytes(data)
+        del data
+        cached = originals_cache.put(job_id, src)
+
+    cutout_sets, ticket = await plan_run(room_type, styles, tier, mode)
+    try:
+        # New revision suffix so earlier staged results of this job stay intact
+        rev = uuid.uuid4().hex[:8]
+        original_url = make_public_url(request, storage.url_for(orig_key))
+        if inline:
+            return await stage_inline(
+                request, background, src, job_id, "restage", room_type, styles[0], tier,
+                owner, history_token, orig_key, original_url, inplace=not cached,
+                rev=rev, cutout_sets=cutout_sets,
+            )
+        variants, keys = await stage_variants(
+            request, src, job_id, room_type, styles, inplace=not cached, rev=rev,
+            cutout_sets=cutout_sets, original_url=original_url,
+            concurrency=ticket.cost if ticket is not None else None,
+        )
+        del src
+
+        ledger.record(job_id, owner, "restage", room_type, tier, orig_key, keys)
 
         return {
             "job_id": job_id,
             "room_type": room_type,
-            "furniture_style": furniture_style,
+            "furniture_style": styles[0],
             "tier": tier,
+            "mode": "edit" if cutout_sets is None else "composite",
             "original_url": original_url,
-            "staged_url": staged_url,
+            "staged_url": next(v["staged_url"] for v in variants if v["staged_url"]),
+            "variants": variants,
+            "history_token": history_token,
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI staging failed: {e}")
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
+
+@app.get("/jobs")
+async def list_jobs(
+    request: Request,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+):
+    """
+    Newest-first job history for the owner of the X-History-Token header (issued with
+    every /stage response). Pass back `next_cursor` to get the following page. URLs are
+    signed fresh on each read.
+    """
+    owner, _ = require_owner(request)
+    try:
+        jobs, next_cursor = await asyncio.to_thread(ledger.list_jobs, owner, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    for job in jobs:
+        job["original_url"] = make_public_url(request, storage.url_for(job.pop("original_key")))
+        job["variants"] = [
+            {"furniture_style": v["furniture_style"],
+             "staged_url": make_public_url(request, storage.url_for(v["staged_key"]))}
+            for v in job["variants"]
+        ]
+    return {"jobs": jobs, "next_cursor": next_cursor}
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Peak-memory benchmark for the diff/mask/paste + final encode stage.
+
+Each mode runs in a fresh child process so ru_maxrss reflects only that mode:
+
+    python scripts/bench_memory.py --mp 48
+    python scripts/bench_memory.py --mp 48 --strip-rows 128 256 512
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def _reset_peak() -> None:
+    # Linux: writing 5 to clear_refs resets VmHWM (peak RSS) to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # Fallback: ru_maxrss (KiB on Linux, bytes on macOS); cannot be reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _inputs(mp: float):
+    from PIL import Image, ImageDraw
+
+    W = int((mp * 1e6 * 4 / 3) ** 0.5)
+    H = int(W * 3 / 4)
+    base = Image.linear_gradient("L").resize((W, H)).convert("RGB")
+
+    # Model output comes back small (~1.5 MP); furniture = a few solid blocks
+    edited = base.resize((1536, 1152), Image.LANCZOS)
+    d = ImageDraw.Draw(edited)
+    d.rectangle((300, 700, 1100, 1000), fill=(120, 90, 60))
+    d.rectangle((1200, 650, 1450, 1050), fill=(40, 40, 40))
+    return base, edited
+
+
+def _child(mode: str, mp: float, strip_rows: int) -> None:
+    from staging import pipeline
+
+    base, edited = _inputs(mp)
+    _reset_peak()
+    before = _peak_mb()
+    t0 = time.perf_counter()
+    if mode == "full":
+        out, _ = pipeline._composite_full(base, edited)
+    else:
+        out, _ = pipeline._composite_strips(base, edited, strip_rows=strip_rows, inplace=True)
+    del base
+    data = pipeline.encode_jpeg(out, quality=95)
+    elapsed = time.perf_counter() - t0
+    print(f"{mode:<6} rows={strip_rows if mode == 'strips' else '-':<5} "
+          f"inputs={before:7.1f} MB  peak={_peak_mb():7.1f} MB  "
+          f"delta={_peak_mb() - before:7.1f} MB  time={elapsed:5.2f}s  jpeg={len(data) / 1e6:.1f} MB")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mp", type=float, default=48.0, help="megapixels of the synthetic upload")
+    ap.add_argument("--strip-rows", type=int, nargs="+", default=[256])
+    ap.add_argument("--child", nargs=3, metavar=("MODE", "MP", "ROWS"), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        mode, mp, rows = args.child
+        _child(mode, float(mp), int(rows))
+        return
+
+    runs = [("full", 0)] + [("strips", r) for r in args.strip_rows]
+    for mode, rows in runs:
+        subprocess.run([sys.executable, __file__, "--child", mode, str(args.mp), str(rows)], check=True)
+
+
+if __name__ == "__main__":
+    main()
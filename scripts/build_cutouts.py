@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Pre-generate the cutout library used by the local compositing mode (mode=composite).
+
+    python scripts/build_cutouts.py                          # every room x every style
+    python scripts/build_cutouts.py --rooms Bedroom --styles Modern Coastal
+    python scripts/build_cutouts.py --missing-only
+
+Each (room, style) costs three Images calls (primary piece, rug, side piece) plus rembg.
+Cutouts are written to storage under cutouts/<room>/<style>/<slot>.png.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.storage import get_storage  # noqa: E402
+from staging.cutouts import ROOM_ITEMS, SLOTS, CutoutLibrary, cutout_key  # noqa: E402
+from staging.generator_openai import STYLE_HINTS  # noqa: E402
+
+
+def _exists(storage, room: str, style: str) -> bool:
+    try:
+        for slot in SLOTS:
+            storage.load_bytes(cutout_key(room, style, slot))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rooms", nargs="+", default=list(ROOM_ITEMS))
+    ap.add_argument("--styles", nargs="+", default=list(STYLE_HINTS))
+    ap.add_argument("--missing-only", action="store_true")
+    args = ap.parse_args()
+
+    storage = get_storage()
+    library = CutoutLibrary(storage)
+    for room in args.rooms:
+        for style in args.styles:
+            if args.missing_only and _exists(storage, room, style):
+                print(f"skip  {room} / {style}")
+                continue
+            try:
+                await library.build(room, style)
+                print(f"built {room} / {style}")
+            except Exception as e:
+                print(f"FAIL  {room} / {style}: {e}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Import-time profile of the app (what a cold start pays before serving).
+
+    python scripts/profile_imports.py              # import main
+    python scripts/profile_imports.py staging.pipeline staging.generator_openai --top 15
+
+Runs `python -X importtime` in a child process and prints the slowest modules by
+cumulative time.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def profile(module: str, top: int) -> None:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        print(f"import {module} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+        return
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cum_us, name = line.replace("import time:", "|").split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cum_us), int(self_us), name.strip(), depth))
+
+    total = sum(r[0] for r in rows if r[3] == 0)
+    print(f"import {module}: {total / 1000:.0f} ms total")
+    for cum, own, name, _ in sorted(rows, reverse=True)[:top]:
+        print(f"  {cum / 1000:8.1f} ms cum  {own / 1000:7.1f} ms self  {name.strip()}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("modules", nargs="*", default=["main"])
+    ap.add_argument("--top", type=int, default=20)
+    args = ap.parse_args()
+    for m in args.modules:
+        profile(m, args.top)
+
+
+if __name__ == "__main__":
+    main()
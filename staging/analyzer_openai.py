@@ -1,7 +1,9 @@
 # staging/analyzer_openai.py
-import os, httpx, json, re
+import os, json, re
 from typing import Optional, Dict, Any
 
+from .http_client import get_client
+
 RESPONSES_URL = "https://api.openai.com/v1/responses"
 
 def _headers() -> Dict[str, str]:
@@ -49,11 +51,10 @@ async def analyze_room_with_openai(image_url: str) -> Optional[Dict[str, Any]]:
     }
 
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(RESPONSES_URL, headers=_headers(), json=payload)
-            if r.status_code != 200:
-                return None
-            data = r.json()
+        r = await get_client().post(RESPONSES_URL, headers=_headers(), json=payload, timeout=60)
+        if r.status_code != 200:
+            return None
+        data = r.json()
     except Exception:
         return None
 
@@ -1,20 +1,29 @@
 # staging/compositor.py
 from PIL import Image, ImageFilter, ImageStat, ImageEnhance
-import io, os
+import io, math, os
 from typing import Tuple, Dict, Optional
 
+# Furniture + shadows are drawn at most this many pixels (over their bounding box) and
+# upscaled into the photo band by band, so a 48 MP photo never gets full-size RGBA copies.
+COMPOSITE_MAX_PX = int(os.getenv("INSTASTAGE_COMPOSITE_MAX_PX", "2000000"))
+_BAND_ROWS = 256
+_TONE_REF_PX = 1_000_000  # brightness matching only needs a small proxy of the room
+
 def _bytes_to_img(b: bytes) -> Image.Image:
     return Image.open(io.BytesIO(b)).convert("RGBA")
 
 def _clamp(x: int, lo: int, hi: int) -> int:
     return max(lo, min(hi, x))
 
-def _fit_to_width(img: Image.Image, target_w: int) -> Image.Image:
-    if target_w <= 0: return img
-    w, h = img.size
-    if w <= 0: return img
+def _fit_size(size: Tuple[int, int], target_w: int) -> Tuple[int, int]:
+    w, h = size
+    if target_w <= 0 or w <= 0: return size
     scale = target_w / float(w)
-    return img.resize((max(1, int(round(w*scale))), max(1, int(round(h*scale)))), Image.LANCZOS)
+    return max(1, int(round(w*scale))), max(1, int(round(h*scale)))
+
+def _fit_to_width(img: Image.Image, target_w: int) -> Image.Image:
+    size = _fit_size(img.size, target_w)
+    return img if size == img.size else img.resize(size, Image.LANCZOS)
 
 def _shadow_under(layer: Image.Image, blur: int = 18, opacity: int = 90, y_scale: float = 0.25) -> Image.Image:
     alpha = layer.split()[-1]
@@ -85,25 +94,31 @@ def composite_scene_room_aware(
     rug_png: bytes,
     aux_png: bytes,
     floor_y_override: Optional[int] = None,
+    inplace: bool = False,  # write the result into base_rgb (RGB only)
 ) -> Image.Image:
-    base = base_rgb.convert("RGBA")
-    W, H = base.size
+    """
+    Place rug, side piece and main piece (with soft shadows) on the floor line.
+    Layout is in photo coordinates; the layers are drawn over their bounding box only,
+    at proxy scale for big photos, and pasted back band by band.
+    """
+    W, H = base_rgb.size
     spec = _layout_specs(room_type, W, H, floor_y_override)
 
-    prim = _match_tone(base_rgb, _bytes_to_img(primary_png))
-    rug  = _match_tone(base_rgb, _bytes_to_img(rug_png))
-    aux  = _match_tone(base_rgb, _bytes_to_img(aux_png))
-
-    rug  = _fit_to_width(rug,  int(W * spec["rug_w"]))
-    prim = _fit_to_width(prim, int(W * spec["main_w"]))
-    aux  = _fit_to_width(aux,  int(W * spec["aux_w"]))
+    k = max(1, int(math.sqrt(W * H / float(_TONE_REF_PX))))
+    tone_ref = base_rgb.reduce(k) if k > 1 else base_rgb
+    layers = {
+        "main": _match_tone(tone_ref, _bytes_to_img(primary_png)),
+        "rug":  _match_tone(tone_ref, _bytes_to_img(rug_png)),
+        "aux":  _match_tone(tone_ref, _bytes_to_img(aux_png)),
+    }
+    sizes = {name: _fit_size(img.size, int(W * spec[f"{name}_w"])) for name, img in layers.items()}
 
     floor_y = spec["floor_y"]
 
     # Optional obstacle-aware x center injected by pipeline
     x_center_hint = os.getenv("INSTASTAGE_MAIN_XCENTER")
-    def place(layer: Image.Image, y_offset: int = 0, use_hint: bool = False) -> Tuple[int, int]:
-        w, h = layer.size
+    def place(size: Tuple[int, int], y_offset: int = 0, use_hint: bool = False) -> Tuple[int, int]:
+        w, h = size
         if use_hint and x_center_hint is not None:
             xc = int(x_center_hint)
             x = int(xc - w / 2)
@@ -112,27 +127,42 @@ def composite_scene_room_aware(
         y = floor_y - h + y_offset
         return _clamp(x, 0, max(0, W - w)), _clamp(y, 0, max(0, H - h))
 
-    rug_pos   = place(rug,  spec["rug_y"],  use_hint=False)
-    aux_pos   = place(aux,  spec["aux_y"],  use_hint=False)
-    main_pos  = place(prim, spec["main_y"], use_hint=True)   # main piece avoids obstacles
+    pos = {
+        "rug":  place(sizes["rug"],  spec["rug_y"],  use_hint=False),
+        "aux":  place(sizes["aux"],  spec["aux_y"],  use_hint=False),
+        "main": place(sizes["main"], spec["main_y"], use_hint=True),   # main piece avoids obstacles
+    }
 
-    canvas = base.copy()
-    br, or_, yr = spec["shadow"]["rug"]
-    bt, ot, yt = spec["shadow"]["aux"]
-    bm, om, ym = spec["shadow"]["main"]
+    # Bounding box of everything drawn (shadows share their layer's box)
+    x0 = min(pos[n][0] for n in pos)
+    y0 = min(pos[n][1] for n in pos)
+    x1 = min(W, max(pos[n][0] + sizes[n][0] for n in pos))
+    y1 = min(H, max(pos[n][1] + sizes[n][1] for n in pos))
+    bw, bh = x1 - x0, y1 - y0
+    sc = min(1.0, math.sqrt(COMPOSITE_MAX_PX / float(bw * bh)))
 
+    overlay = Image.new("RGBA", (max(1, int(math.ceil(bw * sc))), max(1, int(math.ceil(bh * sc)))), (0, 0, 0, 0))
     for layer_name in spec["depth"]:
-        if layer_name == "rug":
-            sh = _shadow_under(rug,  blur=br, opacity=or_, y_scale=yr)
-            canvas.alpha_composite(sh, rug_pos)
-            canvas.alpha_composite(rug, rug_pos)
-        elif layer_name == "aux":
-            sh = _shadow_under(aux,  blur=bt, opacity=ot, y_scale=yt)
-            canvas.alpha_composite(sh, aux_pos)
-            canvas.alpha_composite(aux, aux_pos)
-        elif layer_name == "main":
-            sh = _shadow_under(prim, blur=bm, opacity=om, y_scale=ym)
-            canvas.alpha_composite(sh, main_pos)
-            canvas.alpha_composite(prim, main_pos)
-
-    return canvas.convert("RGB")
+        w, h = sizes[layer_name]
+        layer = layers[layer_name].resize((max(1, int(round(w * sc))), max(1, int(round(h * sc)))), Image.LANCZOS)
+        at = (int(round((pos[layer_name][0] - x0) * sc)), int(round((pos[layer_name][1] - y0) * sc)))
+        blur, opacity, y_scale = spec["shadow"][layer_name]
+        overlay.alpha_composite(_shadow_under(layer, blur=blur * sc, opacity=opacity, y_scale=y_scale), at)
+        overlay.alpha_composite(layer, at)
+    del layers
+
+    if base_rgb.mode != "RGB":
+        out = base_rgb.convert("RGB")
+    else:
+        out = base_rgb if inplace else base_rgb.copy()
+    ow, oh = overlay.size
+    overlay = overlay.convert("RGBa")  # premultiplied, so upscaling doesn't fringe edges
+    for top in range(0, bh, _BAND_ROWS):
+        bottom = min(bh, top + _BAND_ROWS)
+        if (ow, oh) == (bw, bh):
+            band = overlay.crop((0, top, bw, bottom))
+        else:
+            band = overlay.resize((bw, bottom - top), Image.BILINEAR, box=(0, top * oh / bh, ow, bottom * oh / bh))
+        band = band.convert("RGBA")
+        out.paste(band.convert("RGB"), (x0, y0 + top), band.getchannel("A"))
+    return out
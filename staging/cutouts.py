@@ -0,0 +1,91 @@
+# staging/cutouts.py
+import asyncio
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from utils import metrics
+
+# What compositor.composite_scene_room_aware places for each room: main piece, rug, side piece.
+SLOTS = ("primary", "rug", "aux")
+ROOM_ITEMS = {
+    "Living room": {"primary": "sofa", "rug": "area rug", "aux": "coffee table"},
+    "Bedroom": {"primary": "bed with bedding", "rug": "area rug", "aux": "nightstand"},
+    "Dining room": {"primary": "dining table with chairs", "rug": "area rug", "aux": "sideboard"},
+    "Home office": {"primary": "desk with office chair", "rug": "area rug", "aux": "bookshelf"},
+    "Kids room": {"primary": "kids bed", "rug": "play rug", "aux": "toy storage chest"},
+    "Kitchen": {"primary": "bar stools", "rug": "runner rug", "aux": "potted plant"},
+    "Bathroom": {"primary": "vanity stool", "rug": "bath mat", "aux": "towel ladder"},
+}
+
+CACHE_ENTRIES = int(os.getenv("INSTASTAGE_CUTOUT_CACHE", "32"))
+# Off by default: generating a missing set is three paid Images calls + rembg.
+GENERATE_ON_MISS = os.getenv("INSTASTAGE_CUTOUTS_GENERATE_ON_MISS", "0").strip() in ("1", "true", "True", "yes")
+CUTOUT_WIDTH_PX = 1536
+
+
+def _slug(s: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", (s or "").lower()).strip("-") or "default"
+
+
+def cutout_key(room: str, style: str, slot: str) -> str:
+    return f"cutouts/{_slug(room)}/{_slug(style)}/{slot}.png"
+
+
+class CutoutLibrary:
+    """
+    Pre-generated transparent furniture cutouts per (room, style), kept in storage under
+    cutouts/<room>/<style>/<slot>.png (see scripts/build_cutouts.py) with a small
+    in-memory LRU in front, so compositing mode never waits on a model call.
+    """
+
+    def __init__(self, storage, max_entries: int = CACHE_ENTRIES, generate_on_miss: bool = GENERATE_ON_MISS):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.generate_on_miss = generate_on_miss
+        self._cache: "OrderedDict[Tuple[str, str], Dict[str, bytes]]" = OrderedDict()
+
+    async def get(self, room_type: str, style: str, generate: Optional[bool] = None) -> Optional[Dict[str, bytes]]:
+        """
+        {slot: png bytes} for this room/style, or None if the set isn't in the library.
+        With `generate` (default: generate_on_miss) a missing set is built (paid calls).
+        """
+        # main imports this module at startup; the pipeline stays lazy (warm-up loads it)
+        from .pipeline import _normalize_room
+
+        room = _normalize_room(room_type)
+        key = (room, _slug(style))
+        hit = self._cache.get(key)
+        if hit is not None:
+            self._cache.move_to_end(key)
+            metrics.incr("cutouts.hit")
+            return hit
+
+        try:
+            pieces = {}
+            for slot in SLOTS:
+                pieces[slot] = await asyncio.to_thread(self.storage.load_bytes, cutout_key(room, style, slot))
+        except FileNotFoundError:
+            metrics.incr("cutouts.miss")
+            if not (self.generate_on_miss if generate is None else generate):
+                return None
+            pieces = await self.build(room, style)
+
+        self._cache[key] = pieces
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return pieces
+
+    async def build(self, room_type: str, style: str) -> Dict[str, bytes]:
+        """Generate (paid) and store the cutout set for one room/style."""
+        from .generator_openai import generate_openai_png
+        from .pipeline import _normalize_room
+
+        room = _normalize_room(room_type)
+        items = ROOM_ITEMS[room]
+        pngs = await asyncio.gather(*(generate_openai_png(items[slot], style, CUTOUT_WIDTH_PX) for slot in SLOTS))
+        pieces = dict(zip(SLOTS, pngs))
+        for slot, png in pieces.items():
+            await asyncio.to_thread(self.storage.save_bytes, cutout_key(room, style, slot), png, "image/png")
+        return pieces
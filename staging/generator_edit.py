@@ -2,10 +2,13 @@
 import os
 import io
 import base64
-import requests
-from typing import Optional
+from typing import Optional, Union
 from PIL import Image
 
+from .hedging import call_with_deadline, deadline_for
+from .http_client import get_client
+from .image_io import ImageHandle
+
 # No env checks at import. We'll check at call time.
 API_URL = "https://api.openai.com/v1/images/edits"
 
@@ -32,7 +35,7 @@ def _to_png_bytes(img: Image.Image) -> bytes:
 
 
 async def edit_add_furniture(
-    base_image: Image.Image,
+    base_image: Union[Image.Image, ImageHandle],
     room_type: str,
     furniture_style: str,
     rgba_mask: Optional[Image.Image] = None,  # If None, allow full-scene edit
@@ -51,7 +54,11 @@ async def edit_add_furniture(
         f"but avoid global color/contrast changes. Keep the composition authentic and photorealistic."
     )
 
-    img_bytes = _to_jpeg_bytes(base_image)
+    # A handle reuses the upload/storage JPEG instead of encoding yet another copy
+    if isinstance(base_image, ImageHandle):
+        img_bytes = base_image.jpeg()
+    else:
+        img_bytes = _to_jpeg_bytes(base_image)
     files = {"image": ("input.jpg", img_bytes, "image/jpeg")}
 
     # If a mask is provided, send it (transparent = editable).
@@ -66,11 +73,16 @@ async def edit_add_furniture(
     }
     headers = {"Authorization": f"Bearer {key}"}
 
-    r = requests.post(API_URL, headers=headers, data=data, files=files, timeout=120)
-    if r.status_code != 200:
-        raise RuntimeError(f"OpenAI Image Edit error {r.status_code}: {r.text[:800]}")
+    deadline = deadline_for("edit", 120)
+
+    async def _post() -> bytes:
+        # Async client: concurrent edits overlap, and a losing hedge is really cancelled
+        r = await get_client().post(API_URL, headers=headers, data=data, files=files, timeout=deadline)
+        if r.status_code != 200:
+            raise RuntimeError(f"OpenAI Image Edit error {r.status_code}: {r.text[:800]}")
+        return base64.b64decode(r.json()["data"][0]["b64_json"])
 
-    b64 = r.json()["data"][0]["b64_json"]
-    out = Image.open(io.BytesIO(base64.b64decode(b64)))
+    png = await call_with_deadline("edit", _post, deadline)
+    out = Image.open(io.BytesIO(png))
     # Normalize to RGB for compositing
     return out.convert("RGB")
@@ -1,13 +1,18 @@
 # staging/generator_openai.py
 import os
+import asyncio
 import base64
-import httpx
 import io
+import threading
 from typing import Dict, Any
 from PIL import Image
-import numpy as np
-import cv2
-from rembg import remove as rembg_remove
+from .hedging import call_with_deadline, deadline_for
+from .http_client import get_client
+
+# rembg (and onnxruntime under it) is imported on first use: it is slow to import
+# and not on the default /stage path. See rembg_session().
+_rembg_session = None
+_rembg_lock = threading.Lock()  # matting runs in worker threads; load the model once
 
 IMAGES_URL = "https://api.openai.com/v1/images/generations"
 
@@ -45,7 +50,7 @@ def _prompt(item: str, style: str) -> str:
         f"High fidelity textures. Output should be ideal for background removal."
     )
 
-async def _decode_image_response(data: Dict[str, Any]) -> bytes:
+async def _decode_image_response(data: Dict[str, Any], timeout: float = 180) -> bytes:
     item = data["data"][0]
     b64 = item.get("b64_json")
     if b64:
@@ -53,27 +58,35 @@ async def _decode_image_response(data: Dict[str, Any]) -> bytes:
     url = item.get("url")
     if not url:
         raise RuntimeError(f"Images API returned no image data: {data}")
-    async with httpx.AsyncClient(timeout=180) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        return r.content
+    r = await get_client().get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.content
 
 def _ensure_rgba(png_bytes: bytes) -> Image.Image:
     return Image.open(io.BytesIO(png_bytes)).convert("RGBA")
 
+def rembg_session():
+    """Import rembg and load its model once per process (also used by startup warm-up)."""
+    global _rembg_session
+    with _rembg_lock:
+        if _rembg_session is None:
+            from rembg import new_session
+            _rembg_session = new_session()
+    return _rembg_session
+
 def _matte_if_needed(img_rgba: Image.Image) -> Image.Image:
     """
     If the returned image still has a scene/white background, remove it with rembg.
     """
     # If there is already transparency, keep it; otherwise remove bg.
-    arr = np.array(img_rgba)
-    has_alpha_holes = arr.shape[2] == 4 and np.any(arr[:, :, 3] < 255)
+    has_alpha_holes = img_rgba.mode == "RGBA" and img_rgba.getchannel("A").getextrema()[0] < 255
     if has_alpha_holes:
         return img_rgba
+    from rembg import remove as rembg_remove
     # rembg expects bytes
     buf = io.BytesIO()
     img_rgba.save(buf, "PNG")
-    cut = rembg_remove(buf.getvalue())
+    cut = rembg_remove(buf.getvalue(), session=rembg_session())
     return Image.open(io.BytesIO(cut)).convert("RGBA")
 
 def _pick_size_for_model(model: str, base_width_px: int) -> str:
@@ -85,12 +98,25 @@ def _pick_size_for_model(model: str, base_width_px: int) -> str:
 async def _call_images(model: str, prompt: str, size: str) -> bytes:
     headers = _get_headers()
     payload = {"model": model, "prompt": prompt, "size": size}
-    async with httpx.AsyncClient(timeout=180) as client:
-        resp = await client.post(IMAGES_URL, headers=headers, json=payload)
+    deadline = deadline_for("images", 180)
+
+    async def _generate() -> bytes:
+        resp = await get_client().post(IMAGES_URL, headers=headers, json=payload, timeout=deadline)
         if resp.status_code != 200:
             raise RuntimeError(f"OpenAI Images error {resp.status_code}: {resp.text[:800]}")
         data = resp.json()
-    return await _decode_image_response(data)
+        return await _decode_image_response(data, timeout=deadline)
+
+    return await call_with_deadline("images", _generate, deadline)
+
+def _postprocess(raw: bytes) -> Image.Image:
+    # Decode + rembg matting (onnx inference, seconds): run in a worker thread
+    return _matte_if_needed(_ensure_rgba(raw))
+
+def _png_bytes(img: Image.Image) -> bytes:
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
 
 async def generate_openai_png(item: str, style: str, base_width_px: int) -> bytes:
     """
@@ -102,19 +128,15 @@ async def generate_openai_png(item: str, style: str, base_width_px: int) -> byte
     try:
         size = _pick_size_for_model("gpt-image-1", base_width_px)
         raw = await _call_images("gpt-image-1", prompt, size)
-        img = _ensure_rgba(raw)
-        img = _matte_if_needed(img)
+        img = await asyncio.to_thread(_postprocess, raw)
     except RuntimeError as e:
         msg = str(e)
         if "403" in msg or "must be verified" in msg or "invalid_request" in msg or "model_not_found" in msg:
             # 2) Fallback to dall-e-3
             size = _pick_size_for_model("dall-e-3", base_width_px)
             raw = await _call_images("dall-e-3", prompt, size)
-            img = _ensure_rgba(raw)
-            img = _matte_if_needed(img)
+            img = await asyncio.to_thread(_postprocess, raw)
         else:
             raise
 
-    out = io.BytesIO()
-    img.save(out, "PNG")
-    return out.getvalue()
+    return await asyncio.to_thread(_png_bytes, img)
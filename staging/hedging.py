@@ -0,0 +1,110 @@
+# staging/hedging.py
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from utils import admission, metrics
+
+T = TypeVar("T")
+
+# Hedging is opt-in: a hedge is a second, identical paid model call.
+HEDGE_ENABLED = os.getenv("INSTASTAGE_HEDGE", "0").strip() in ("1", "true", "True", "yes")
+HEDGE_PERCENTILE = float(os.getenv("INSTASTAGE_HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET = float(os.getenv("INSTASTAGE_HEDGE_BUDGET", "0.1"))  # max hedges / calls
+HEDGE_MIN_SAMPLES = int(os.getenv("INSTASTAGE_HEDGE_MIN_SAMPLES", "20"))
+
+_WINDOW = 200
+
+
+class _Stage:
+    """Recent latencies and hedge usage for one kind of call."""
+
+    def __init__(self):
+        self.latencies: Deque[float] = deque(maxlen=_WINDOW)
+        self.calls: Deque[bool] = deque(maxlen=_WINDOW)  # True = this call was hedged
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return metrics.percentile(self.latencies, HEDGE_PERCENTILE)
+
+    def budget_allows(self) -> bool:
+        hedged = sum(1 for h in self.calls if h)
+        return hedged + 1 <= HEDGE_BUDGET * max(1, len(self.calls))
+
+
+_stages: Dict[str, _Stage] = {}
+
+
+def deadline_for(stage: str, default: float) -> float:
+    """Per-stage deadline in seconds, e.g. INSTASTAGE_DEADLINE_EDIT=90."""
+    return float(os.getenv(f"INSTASTAGE_DEADLINE_{stage.upper()}", str(default)))
+
+
+async def call_with_deadline(
+    stage: str,
+    make_call: Callable[[], Awaitable[T]],
+    deadline: float,
+    hedge: bool = HEDGE_ENABLED,
+) -> T:
+    """
+    Await make_call() with a hard deadline. If hedging is on and the call is still
+    running at the stage's latency percentile, an identical second call is started
+    (within the hedge budget) and whichever succeeds first wins; the other is cancelled.
+    A hedge is another paid call, so it needs a free admission slot of its own
+    (admission.borrow_slot) and is skipped otherwise.
+
+    Counts hedge.<stage>.issued / hedge.<stage>.wins / hedge.<stage>.no_slot /
+    deadline.<stage>.hits and records latency.<stage>.
+    """
+    st = _stages.setdefault(stage, _Stage())
+    start = time.monotonic()
+    end = start + deadline
+    tasks = [asyncio.ensure_future(make_call())]
+    hedged = False
+    release_slot = None
+
+    try:
+        delay = st.hedge_delay() if hedge else None
+        if delay is not None and delay < deadline:
+            await asyncio.wait(tasks, timeout=delay)
+            if not tasks[0].done() and st.budget_allows():
+                release_slot = admission.borrow_slot()
+                if release_slot is None:
+                    metrics.incr(f"hedge.{stage}.no_slot")
+                else:
+                    hedged = True
+                    metrics.incr(f"hedge.{stage}.issued")
+                    tasks.append(asyncio.ensure_future(make_call()))
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    elapsed = time.monotonic() - start
+                    st.latencies.append(elapsed)
+                    metrics.observe(f"latency.{stage}", elapsed)
+                    if hedged and t is tasks[1]:
+                        metrics.incr(f"hedge.{stage}.wins")
+                    return t.result()
+                error = error or t.exception()
+        if error is not None and not pending:
+            raise error
+
+        st.latencies.append(deadline)  # keep the percentile honest about slow calls
+        metrics.incr(f"deadline.{stage}.hits")
+        raise TimeoutError(f"{stage} call exceeded its {deadline:g}s deadline")
+    finally:
+        st.calls.append(hedged)
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+        if release_slot is not None:
+            release_slot()
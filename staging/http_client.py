@@ -0,0 +1,32 @@
+# staging/http_client.py
+import os
+import httpx
+from typing import Optional
+
+# One pooled client per process so model calls reuse warm TLS connections
+# (per-call clients paid a fresh handshake to api.openai.com every time).
+KEEPALIVE_S = float(os.getenv("INSTASTAGE_HTTP_KEEPALIVE_S", "30"))
+MAX_CONNECTIONS = int(os.getenv("INSTASTAGE_HTTP_MAX_CONNECTIONS", "50"))
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=60,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_S,
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
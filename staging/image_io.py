@@ -0,0 +1,241 @@
+# staging/image_io.py
+import io
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+from PIL import Image, ImageOps
+
+# Same threshold the pipeline uses to switch to strip processing.
+STRIP_MIN_PIXELS = int(os.getenv("INSTASTAGE_STRIP_MIN_PIXELS", "12000000"))
+
+_EXIF_ORIENTATION = 0x0112
+# APP1 (EXIF/XMP: GPS, camera serials, orientation) and APP13 (IPTC/Photoshop).
+# Adobe (APP14) stays: it changes how the pixels decode. ICC (APP2) stays only for
+# RGB images, whose staged outputs carry the same profile (see encode_jpeg).
+_DROP_MARKERS = (0xE1, 0xED)
+_ICC_MARKER = 0xE2
+# Source modes whose ICC profile (if any) is an RGB profile we can carry to outputs.
+_RGB_PROFILE_MODES = ("RGB", "RGBA")
+
+
+def encode_jpeg(img: Image.Image, quality: int = 95, icc_profile: Optional[bytes] = None) -> bytes:
+    """
+    JPEG-encode for storage. optimize=True makes libjpeg buffer up to 2 bytes/pixel
+    of output in one shot, so it is skipped for strip-sized (very large) images.
+    The ICC profile (`icc_profile`, else the image's own) is embedded, so staged
+    outputs render in the same colour space as the original (e.g. iPhone Display P3).
+    """
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if icc_profile is None:
+        icc_profile = img.info.get("icc_profile")
+    extra = {"icc_profile": icc_profile} if icc_profile and img.mode == "RGB" else {}
+    buf = io.BytesIO()
+    optimize = img.width * img.height < STRIP_MIN_PIXELS
+    img.save(buf, format="JPEG", quality=quality, optimize=optimize, **extra)
+    return buf.getvalue()
+
+
+def _strip_jpeg_metadata(data: bytes, keep_icc: bool = True) -> Optional[bytes]:
+    """
+    Drop EXIF/XMP/IPTC segments (and ICC unless `keep_icc`) from a JPEG without
+    touching the compressed pixels.
+    Returns None if the marker stream looks unusual (caller re-encodes instead).
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    out = [data[:2]]
+    i, n = 2, len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0xDA:  # start of scan: the rest is entropy-coded data
+            out.append(data[i:])
+            return b"".join(out)
+        seglen = int.from_bytes(data[i + 2:i + 4], "big")
+        end = i + 2 + seglen
+        if seglen < 2 or end > n:
+            return None
+        if marker not in _DROP_MARKERS and (keep_icc or marker != _ICC_MARKER):
+            out.append(data[i:end])
+        i = end
+    return None
+
+
+class ImageHandle:
+    """
+    An image together with the encoded bytes it came from.
+
+    Decoding happens at most once (with EXIF orientation applied), and each JPEG
+    encoding is produced at most once. If the upload already is a plain, upright
+    RGB/grayscale JPEG, jpeg() hands back those bytes (metadata stripped) instead
+    of re-encoding; the raw upload is not kept alongside them.
+
+    An RGB source's ICC profile is kept on the decoded image and on every encoding,
+    so originals and staged outputs render alike; other profiles are dropped.
+    """
+
+    def __init__(self, data: Optional[bytes] = None, image: Optional[Image.Image] = None):
+        if data is None and image is None:
+            raise ValueError("ImageHandle needs encoded bytes or an image")
+        self._data = data
+        self._image = image
+        self._jpegs: Dict[int, bytes] = {}
+        self._reusable: Optional[bytes] = None
+        self._size: Optional[Tuple[int, int]] = image.size if image is not None else None
+        self._orientation = 1
+        self._icc: Optional[bytes] = None
+
+        if image is not None:
+            if image.mode in _RGB_PROFILE_MODES:
+                self._icc = image.info.get("icc_profile") or None
+        else:
+            # Header only: format, mode, size, orientation and profile without decoding pixels
+            with Image.open(io.BytesIO(data)) as probe:
+                self._orientation = probe.getexif().get(_EXIF_ORIENTATION, 1)
+                self._size = probe.size if self._orientation in (1, 2, 3, 4) else probe.size[::-1]
+                if probe.mode in _RGB_PROFILE_MODES:
+                    self._icc = probe.info.get("icc_profile") or None
+                if probe.format == "JPEG" and probe.mode in ("RGB", "L") and self._orientation == 1:
+                    self._reusable = _strip_jpeg_metadata(data, keep_icc=self._icc is not None)
+            if self._reusable is not None:
+                # Same pixels (upright, same profile): decode from the stripped copy, drop the upload
+                self._data = self._reusable
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ImageHandle":
+        return cls(data=data)
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "ImageHandle":
+        return cls(image=image)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self._size
+
+    @property
+    def icc_profile(self) -> Optional[bytes]:
+        """ICC profile carried to every encoding of this image (RGB sources only)."""
+        return self._icc
+
+    @property
+    def image(self) -> Image.Image:
+        """Decoded, upright RGB image (decoded on first access)."""
+        if self._image is None:
+            img = Image.open(io.BytesIO(self._data))
+            if self._orientation != 1:
+                img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.load()
+            if self._icc is None:
+                img.info.pop("icc_profile", None)
+            self._image = img
+            self._size = self._image.size
+        return self._image
+
+    def jpeg(self, quality: int = 95) -> bytes:
+        """JPEG bytes for storage/model input; reused or encoded once per quality."""
+        if self._reusable is not None:
+            return self._reusable
+        if quality not in self._jpegs:
+            self._jpegs[quality] = encode_jpeg(self.image, quality=quality)
+        return self._jpegs[quality]
+
+    def nbytes(self) -> int:
+        """Approximate memory held once decoded: RGB pixels plus encoded bytes."""
+        w, h = self._size
+        n = w * h * 3
+        if self._data is not None:
+            n += len(self._data)  # the stripped copy when reusable
+        return n + sum(len(b) for b in self._jpegs.values())
+
+
+def as_handle(img: Union[Image.Image, ImageHandle]) -> ImageHandle:
+    return img if isinstance(img, ImageHandle) else ImageHandle.from_image(img)
+
+
+def memory_limit_bytes() -> Optional[int]:
+    """The container's memory limit (cgroup v2/v1), else physical RAM; None if unknown."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                raw = f.read().strip()
+        except OSError:
+            continue
+        if raw.isdigit() and int(raw) < 1 << 60:  # "max" / huge sentinel = unlimited
+            return int(raw)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def default_cache_bytes(fraction: float = 1 / 16) -> int:
+    """Originals cache budget: INSTASTAGE_ORIGINALS_CACHE_MB, else a small share of RAM."""
+    mb = os.getenv("INSTASTAGE_ORIGINALS_CACHE_MB")
+    if mb:
+        return int(mb) * 1024 * 1024
+    limit = memory_limit_bytes() or 512 * 1024 * 1024
+    return int(limit * fraction)
+
+
+class HandleCache:
+    """
+    Small in-memory LRU of originals keyed by job_id, bounded by approximate bytes.
+
+    Originals below STRIP_MIN_PIXELS whose decoded size fits are kept as the handle
+    itself; those are shared, so callers must not composite into them in place.
+    Larger ones are kept as their encoded JPEG only, and every hit decodes into a
+    fresh handle of its own, so strip mode can still composite in place.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Union[ImageHandle, bytes]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._total = 0
+
+    def get(self, key: str) -> Optional[ImageHandle]:
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        self._items.move_to_end(key)
+        return ImageHandle.from_bytes(entry) if isinstance(entry, bytes) else entry
+
+    def shares(self, handle: ImageHandle) -> bool:
+        """True if `handle` is held by the cache (so must not be composited into)."""
+        return any(entry is handle for entry in self._items.values())
+
+    def put(self, key: str, handle: ImageHandle) -> bool:
+        """
+        Cache `handle` (decoded or as JPEG, see above). Returns True if the handle
+        itself is now shared; False if only its bytes were kept, or nothing fits.
+        """
+        w, h = handle.size
+        entry: Union[ImageHandle, bytes] = handle
+        size = handle.nbytes()
+        if w * h >= STRIP_MIN_PIXELS or size > self.max_bytes // 2:
+            entry = handle.jpeg()
+            size = len(entry)
+        self.pop(key)
+        if size > self.max_bytes // 2:
+            return False
+        self._items[key] = entry
+        self._sizes[key] = size
+        self._total += size
+        while self._total > self.max_bytes:
+            old, _ = self._items.popitem(last=False)
+            self._total -= self._sizes.pop(old)
+        return entry is handle
+
+    def pop(self, key: str) -> None:
+        """Drop `key` if cached."""
+        if key in self._items:
+            del self._items[key]
+            self._total -= self._sizes.pop(key)
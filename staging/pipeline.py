@@ -1,8 +1,25 @@
 # staging/pipeline.py
-from typing import Optional
+import asyncio
+import math
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 from PIL import Image, ImageChops, ImageFilter, ImageOps
 
+from .compositor import composite_scene_room_aware
 from .generator_edit import edit_add_furniture  # calls OpenAI Images Edit
+from .image_io import STRIP_MIN_PIXELS, ImageHandle, as_handle, encode_jpeg  # noqa: F401
+
+# Very large photos (48 MP phone shots, >= STRIP_MIN_PIXELS) are diffed/masked/pasted
+# in horizontal strips so peak memory tracks the strip size instead of the full frame.
+STRIP_ROWS = int(os.getenv("INSTASTAGE_STRIP_ROWS", "256"))
+
+# Changed regions smaller than this fraction of the frame are treated as noise and not pasted.
+MIN_REGION_FRAC = float(os.getenv("INSTASTAGE_MIN_REGION_FRAC", "0.0005"))
+REGION_GRID_CELLS = 250_000
+
+# Local compositing takes no admission slot; this bounds how many run at once (CPU + memory).
+COMPOSITE_CONCURRENCY = int(os.getenv("INSTASTAGE_COMPOSITE_CONCURRENCY", "2"))
+_composite_slots = asyncio.Semaphore(max(1, COMPOSITE_CONCURRENCY))
 
 
 def _normalize_room(room_type: str) -> str:
@@ -42,6 +59,11 @@ def _stable_change_mask(
     # Pre-blur slightly so thresholding doesn’t produce 1-pixel bands
     diff = diff.filter(ImageFilter.GaussianBlur(radius=0.8))
 
+    return _mask_from_diff(diff, thr, grow_px, blur_px)
+
+
+def _mask_from_diff(diff: Image.Image, thr: int, grow_px: int, blur_px: float) -> Image.Image:
+    """Threshold/grow/feather an autocontrasted, pre-blurred 'L' difference."""
     # Hard-ish threshold -> binary regions of true change
     mask = diff.point(lambda p: 255 if p > thr else 0).convert("L")
 
@@ -64,42 +86,429 @@ def _stable_change_mask(
     return mask
 
 
-async def stage_image_async(
+def _mask_halo(grow_px: int, blur_px: float) -> int:
+    """Rows of context a strip needs so its filters see the same neighbours as the full frame."""
+    return int(math.ceil(3 * (0.8 + max(0.0, blur_px) + 0.6))) + max(0, grow_px) + 1 + 4
+
+
+def _autocontrast_lut(hist: List[int], cutoff: int = 1) -> List[int]:
+    """
+    Same lookup table ImageOps.autocontrast(cutoff=...) builds for an 'L' image,
+    but from a histogram we accumulated strip by strip.
+    """
+    h = list(hist[:256])
+    n = sum(h)
+
+    cut = n * cutoff // 100
+    for lo in range(256):
+        if cut > h[lo]:
+            cut -= h[lo]
+            h[lo] = 0
+        else:
+            h[lo] -= cut
+            cut = 0
+        if cut <= 0:
+            break
+
+    cut = n * cutoff // 100
+    for hi in range(255, -1, -1):
+        if cut > h[hi]:
+            cut -= h[hi]
+            h[hi] = 0
+        else:
+            h[hi] -= cut
+            cut = 0
+        if cut <= 0:
+            break
+
+    lo = next((i for i in range(256) if h[i]), 255)
+    hi = next((i for i in range(255, -1, -1) if h[i]), 0)
+    if hi <= lo:
+        return list(range(256))
+
+    scale = 255.0 / (hi - lo)
+    offset = -lo * scale
+    return [max(0, min(255, int(ix * scale + offset))) for ix in range(256)]
+
+
+def _edited_rows(edited: Image.Image, size, top: int, bottom: int) -> Image.Image:
+    """Rows [top, bottom) of `edited` as if it had first been resized to `size`."""
+    W, H = size
+    if edited.size == size:
+        return edited.crop((0, top, W, bottom))
+    ew, eh = edited.size
+    sy = eh / float(H)
+    # box= resamples just this band of the source; no full-resolution copy is made
+    return edited.resize((W, bottom - top), Image.LANCZOS, box=(0, top * sy, ew, bottom * sy))
+
+
+def _grid_factor(size: Tuple[int, int]) -> int:
+    """Cell size (px) of the coarse grid regions are labelled on; keeps the grid <= REGION_GRID_CELLS."""
+    W, H = size
+    return max(8, int(math.ceil(math.sqrt(W * H / float(REGION_GRID_CELLS)))))
+
+
+def _label_regions(grid: Image.Image, f: int, size: Tuple[int, int], min_area: int) -> Tuple[List[dict], Image.Image]:
+    """
+    8-connected components of a coarse alpha grid (each cell = f x f mask pixels).
+    Components whose alpha-weighted area is below `min_area` px are dropped as noise.
+    Returns ([{"box": [x0, y0, x1, y1], "area": px}], keep grid: 255 on kept cells).
+    """
+    W, H = size
+    gw, gh = grid.size
+    vals = grid.tobytes()
+    seen = bytearray(gw * gh)
+    keep = bytearray(gw * gh)
+    regions = []
+
+    for start in range(gw * gh):
+        if not vals[start] or seen[start]:
+            continue
+        seen[start] = 1
+        stack, cells, total = [start], [], 0
+        while stack:
+            i = stack.pop()
+            cells.append(i)
+            total += vals[i]
+            x, y = i % gw, i // gw
+            for yy in (y - 1, y, y + 1):
+                if yy < 0 or yy >= gh:
+                    continue
+                for xx in (x - 1, x, x + 1):
+                    if 0 <= xx < gw:
+                        j = yy * gw + xx
+                        if vals[j] and not seen[j]:
+                            seen[j] = 1
+                            stack.append(j)
+
+        area = int(total / 255.0 * f * f)
+        if area < min_area:
+            continue
+        xs = [i % gw for i in cells]
+        ys = [i // gw for i in cells]
+        for i in cells:
+            keep[i] = 255
+        regions.append({
+            "box": [min(xs) * f, min(ys) * f, min(W, (max(xs) + 1) * f), min(H, (max(ys) + 1) * f)],
+            "area": area,
+        })
+
+    regions.sort(key=lambda r: -r["area"])
+    return regions, Image.frombytes("L", (gw, gh), bytes(keep))
+
+
+def _merge_boxes(boxes: List[List[int]]) -> List[Tuple[int, int, int, int]]:
+    """Union overlapping boxes so every pixel is pasted at most once."""
+    out = [tuple(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        acc: List[Tuple[int, int, int, int]] = []
+        for b in out:
+            for k, m in enumerate(acc):
+                if b[0] < m[2] and m[0] < b[2] and b[1] < m[3] and m[1] < b[3]:
+                    acc[k] = (min(b[0], m[0]), min(b[1], m[1]), max(b[2], m[2]), max(b[3], m[3]))
+                    merged = True
+                    break
+            else:
+                acc.append(b)
+        out = acc
+    return out
+
+
+def _kept_alpha(alpha: Image.Image, keep: Image.Image, f: int, box: Tuple[int, int, int, int]) -> Image.Image:
+    """`alpha` (already cropped to `box`) with dropped noise components zeroed out."""
+    cx0, cy0 = box[0] // f, box[1] // f
+    cx1, cy1 = -(-box[2] // f), -(-box[3] // f)
+    k = keep.crop((cx0, cy0, cx1, cy1)).resize(((cx1 - cx0) * f, (cy1 - cy0) * f), Image.NEAREST)
+    ox, oy = box[0] - cx0 * f, box[1] - cy0 * f
+    k = k.crop((ox, oy, ox + alpha.width, oy + alpha.height))
+    return ImageChops.multiply(alpha, k)
+
+
+def _composite_full(
+    base: Image.Image,
+    edited: Image.Image,
+    thr: int = 16,
+    grow_px: int = 3,
+    blur_px: float = 2.0,
+    min_region_frac: Optional[float] = None,
+    inplace: bool = False,
+) -> Tuple[Image.Image, List[dict]]:
+    if min_region_frac is None:
+        min_region_frac = MIN_REGION_FRAC
+    if edited.size != base.size:
+        edited = edited.resize(base.size, Image.LANCZOS)
+    if edited.mode != "RGB":
+        edited = edited.convert("RGB")
+
+    alpha = _stable_change_mask(
+        original=base,
+        edited=edited,
+        thr=thr,
+        grow_px=grow_px,
+        blur_px=blur_px,
+    )
+
+    # Connected changed regions; paste only those (cost scales with changed area)
+    f = _grid_factor(base.size)
+    min_area = int(min_region_frac * base.width * base.height)
+    regions, keep = _label_regions(alpha.reduce(f), f, base.size, min_area)
+
+    if base.mode != "RGB":
+        out = base.convert("RGB")
+    else:
+        out = base if inplace else base.copy()
+    for box in _merge_boxes([r["box"] for r in regions]):
+        out.paste(edited.crop(box), box[:2], _kept_alpha(alpha.crop(box), keep, f, box))
+    return out, regions
+
+
+def _strip_mask(
+    base: Image.Image,
+    edited: Image.Image,
+    top: int,
+    bottom: int,
+    lut: List[int],
+    thr: int,
+    grow_px: int,
+    blur_px: float,
+) -> Tuple[Image.Image, Image.Image]:
+    """(edited rows, mask) for base rows [top, bottom)."""
+    W = base.width
+    ed = _edited_rows(edited, base.size, top, bottom)
+    diff = ImageChops.difference(base.crop((0, top, W, bottom)), ed).convert("L").point(lut)
+    diff = diff.filter(ImageFilter.GaussianBlur(radius=0.8))
+    return ed, _mask_from_diff(diff, thr, grow_px, blur_px)
+
+
+def _composite_strips(
     base: Image.Image,
+    edited: Image.Image,
+    thr: int = 16,
+    grow_px: int = 3,
+    blur_px: float = 2.0,
+    strip_rows: int = STRIP_ROWS,
+    inplace: bool = False,
+    min_region_frac: Optional[float] = None,
+) -> Tuple[Image.Image, List[dict]]:
+    """
+    Strip-wise equivalent of _composite_full. Each strip is processed with a halo of
+    extra rows so blur/grow filters match the full-frame result, and `edited` is
+    upscaled one band at a time. With inplace=True the result is written into `base`.
+    """
+    if min_region_frac is None:
+        min_region_frac = MIN_REGION_FRAC
+    if base.mode != "RGB":
+        base, inplace = base.convert("RGB"), True
+    if edited.mode != "RGB":
+        edited = edited.convert("RGB")
+
+    W, H = base.size
+    halo = _mask_halo(grow_px, blur_px)
+    f = _grid_factor(base.size)
+    # Strips start on grid-cell boundaries so their reduced masks tile the grid exactly
+    rows = -(-max(strip_rows, 2 * halo) // f) * f
+
+    # Pass 1: global histogram of the difference, so autocontrast behaves as in full-frame mode
+    hist = [0] * 256
+    for y0 in range(0, H, rows):
+        y1 = min(H, y0 + rows)
+        ed = _edited_rows(edited, base.size, y0, y1)
+        diff = ImageChops.difference(base.crop((0, y0, W, y1)), ed).convert("L")
+        for i, c in enumerate(diff.histogram()):
+            hist[i] += c
+        del ed, diff
+    lut = _autocontrast_lut(hist, cutoff=1)
+
+    # Pass 2: masks, kept only as a coarse grid -> connected regions
+    grid = Image.new("L", (-(-W // f), -(-H // f)), 0)
+    for y0 in range(0, H, rows):
+        y1 = min(H, y0 + rows)
+        top, bottom = max(0, y0 - halo), min(H, y1 + halo)
+        _, mask = _strip_mask(base, edited, top, bottom, lut, thr, grow_px, blur_px)
+        grid.paste(mask.crop((0, y0 - top, W, y1 - top)).reduce(f), (0, y0 // f))
+        del mask
+    regions, keep = _label_regions(grid, f, base.size, int(min_region_frac * W * H))
+    boxes = _merge_boxes([r["box"] for r in regions])
+
+    # Pass 3: only strips that intersect a kept region; paste region ∩ strip. When writing
+    # into `base`, a strip is pasted only after the next strip has cropped its (still
+    # original) halo rows.
+    out = base if inplace else base.copy()
+    pending: List[tuple] = []
+    for y0 in range(0, H, rows):
+        y1 = min(H, y0 + rows)
+        hits = [b for b in boxes if b[1] < y1 and b[3] > y0]
+        if not hits:
+            continue
+        top, bottom = max(0, y0 - halo), min(H, y1 + halo)
+        ed, mask = _strip_mask(base, edited, top, bottom, lut, thr, grow_px, blur_px)
+        for args in pending:
+            out.paste(*args)
+        pending = []
+
+        for b in hits:
+            box = (b[0], max(b[1], y0), b[2], min(b[3], y1))
+            local = (box[0], box[1] - top, box[2], box[3] - top)
+            a = _kept_alpha(mask.crop(local), keep, f, box)
+            pending.append((ed.crop(local), box[:2], a))
+        del ed, mask
+
+    for args in pending:
+        out.paste(*args)
+    return out, regions
+
+
+def _composite_changes(
+    base: Image.Image, edited: Image.Image, inplace: bool = False
+) -> Tuple[Image.Image, List[dict]]:
+    """
+    Build stable mask (this is where the seam fix happens) and paste only the changed
+    regions. Very large photos go strip by strip to keep peak memory bounded.
+    Returns (staged image, regions [{box: [x0, y0, x1, y1], area}], largest first).
+    """
+    if base.width * base.height >= STRIP_MIN_PIXELS:
+        return _composite_strips(base, edited, thr=16, grow_px=3, blur_px=2.0, inplace=inplace)
+    return _composite_full(base, edited, thr=16, grow_px=3, blur_px=2.0, inplace=inplace)
+
+
+async def stage_image_async(
+    base: Union[Image.Image, ImageHandle],
     room_type: str,
     style: str,
     floor_y_override: Optional[int] = None,  # kept for signature compat; unused here
+    inplace: bool = False,  # allow writing the result into `base`
 ) -> Image.Image:
     """
     Furniture-only compositing:
       1) Let the model stage freely (we filter afterward).
       2) Compute a robust, feathered change-mask.
       3) Paste ONLY changed pixels over the original (floors/walls/ceiling preserved).
+    Pass an ImageHandle to let the model input reuse the upload's JPEG bytes.
     """
     room = _normalize_room(room_type)
+    handle = as_handle(base)
 
     # 1) Ask the model to add furniture (no mask limits; we’ll filter)
     edited = await edit_add_furniture(
-        base_image=base,
+        base_image=handle,
         room_type=room,
         furniture_style=style,
         rgba_mask=None,
     )
 
-    # 2) Size guard
-    if edited.size != base.size:
-        edited = edited.resize(base.size, Image.LANCZOS)
+    # 2) + 3) Mask and composite over the original (CPU-bound: off the event loop)
+    staged, _ = await asyncio.to_thread(lambda: _composite_changes(handle.image, edited, inplace=inplace))
+    return staged
 
-    # 3) Build stable mask (this is where the seam fix happens)
-    alpha = _stable_change_mask(
-        original=base,
-        edited=edited,
-        thr=16,
-        grow_px=3,
-        blur_px=2.0
+
+def stage_composite(
+    base: Union[Image.Image, ImageHandle],
+    room_type: str,
+    cutouts: Dict[str, bytes],
+    floor_y_frac: Optional[float] = None,
+    inplace: bool = False,  # allow writing the result into `base`
+) -> Image.Image:
+    """
+    Local compositing mode: place cached furniture cutouts ({primary, rug, aux} PNGs)
+    with the room-aware layout. No model call; floor_y_frac (from the analyzer) sets
+    the floor line, otherwise the compositor's default is used. Only the furniture's
+    bounding box of the photo is touched.
+    """
+    img = as_handle(base).image
+    floor_y = int(img.height * floor_y_frac) if floor_y_frac is not None else None
+    return composite_scene_room_aware(
+        img,
+        _normalize_room(room_type),
+        cutouts["primary"],
+        cutouts["rug"],
+        cutouts["aux"],
+        floor_y_override=floor_y,
+        inplace=inplace,
     )
 
-    # 4) Composite
-    out = base.convert("RGB").copy()
-    out.paste(edited.convert("RGB"), (0, 0), alpha)
-    return out
+
+async def stage_styles_async(
+    base: Union[Image.Image, ImageHandle],
+    room_type: str,
+    styles: List[str],
+    inplace: bool = False,  # the last variant may be written into `base`
+    cutouts: Optional[Dict[str, Dict[str, bytes]]] = None,  # {style: cutout set} -> compositing mode
+    floor_y_frac: Optional[float] = None,
+    return_exceptions: bool = False,
+    concurrency: Optional[int] = None,  # max model edits in flight (admission slots held)
+) -> AsyncIterator[Tuple[str, Union[Image.Image, Exception], Optional[List[dict]]]]:
+    """
+    Stage one photo in several furniture styles. The original is decoded and the
+    model input encoded once; the per-style edits run concurrently, and each
+    result is masked against the shared base as soon as it arrives. Decoding,
+    encoding and compositing run in a worker thread so the event loop stays free.
+    With `cutouts`, styles are composited locally from the cutout library instead.
+    Yields (style, staged image, changed regions) in completion order; regions are
+    None in compositing mode. A failed style raises (cancelling the others), or with
+    return_exceptions=True is yielded as (style, exception, None) while the rest finish.
+    """
+    room = _normalize_room(room_type)
+    handle = as_handle(base)
+    if cutouts is not None:
+        for i, style in enumerate(styles):
+            last = inplace and i == len(styles) - 1
+            try:
+                async with _composite_slots:
+                    staged = await asyncio.to_thread(
+                        stage_composite, handle, room, cutouts[style], floor_y_frac, last
+                    )
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                staged = e
+            yield style, staged, None
+        return
+
+    await asyncio.to_thread(handle.jpeg)  # encode the shared model input before fanning out
+
+    sem = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def _edit(style: str) -> Tuple[str, Union[Image.Image, Exception]]:
+        try:
+            if sem is not None:
+                await sem.acquire()
+            try:
+                edited = await edit_add_furniture(
+                    base_image=handle,
+                    room_type=room,
+                    furniture_style=style,
+                    rgba_mask=None,
+                )
+            finally:
+                if sem is not None:
+                    sem.release()
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return style, e
+        return style, edited
+
+    tasks = [asyncio.ensure_future(_edit(s)) for s in styles]
+    try:
+        remaining = len(tasks)
+        for fut in asyncio.as_completed(tasks):
+            style, edited = await fut
+            remaining -= 1
+            if isinstance(edited, Exception):
+                yield style, edited, None
+                continue
+            try:
+                staged, regions = await asyncio.to_thread(
+                    lambda: _composite_changes(handle.image, edited, inplace=inplace and remaining == 0)
+                )
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                staged, regions = e, None
+            del edited
+            yield style, staged, regions
+    finally:
+        for t in tasks:
+            t.cancel()
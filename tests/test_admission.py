@@ -0,0 +1,72 @@
+# tests/test_admission.py
+import asyncio
+
+from utils.admission import AdmissionScheduler
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_multi_slot_paid_job_is_not_starved_by_cheap_free_jobs():
+    async def scenario():
+        s = AdmissionScheduler(capacity=4)
+        order = []
+
+        async def job(tier, cost, name):
+            ticket = await s.acquire(tier, cost)
+            order.append(name)
+            return ticket
+
+        # Free tier at its cap (2 of 4), then a 4-style pro job arrives
+        running = [await s.acquire("free") for _ in range(2)]
+        pro = asyncio.ensure_future(job("pro", 4, "pro"))
+        await _settle()
+
+        # Cheap free jobs keep arriving while the running ones finish
+        frees = []
+        for i in range(6):
+            frees.append(asyncio.ensure_future(job("free", 1, f"free{i}")))
+            await _settle()
+            if running:
+                s.release(running.pop(0))
+                await _settle()
+
+        assert order == ["pro"]
+        s.release(pro.result())
+        released = set()
+        while len(released) < len(frees):
+            await _settle()
+            for f in frees:
+                if f.done() and f not in released:
+                    released.add(f)
+                    s.release(f.result())
+        assert order[0] == "pro" and sorted(order[1:]) == [f"free{i}" for i in range(6)]
+        assert s.snapshot()["in_flight"] == 0
+
+    _run(scenario())
+
+
+def test_cancelled_waiter_gives_up_its_held_slots():
+    async def scenario():
+        s = AdmissionScheduler(capacity=4)
+        held = await s.acquire("free")
+        pro = asyncio.ensure_future(s.acquire("pro", 4))
+        await _settle()
+        free = asyncio.ensure_future(s.acquire("free"))
+        await _settle()
+        assert not pro.done() and not free.done()  # free waits behind the held-back pro job
+
+        pro.cancel()
+        await _settle()
+        assert free.done()
+        s.release(free.result())
+        s.release(held)
+        assert s.snapshot()["in_flight"] == 0
+
+    _run(scenario())
@@ -0,0 +1,227 @@
+# utils/admission.py
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from utils import metrics
+
+# Tier names as sent by the app (StoreKit "pro.monthly" entitlement -> "pro").
+_TIER_ALIASES = {"pro": "pro", "paid": "pro", "premium": "pro", "plus": "pro"}
+DEFAULT_TIER = "free"
+
+MAX_CONCURRENCY = int(os.getenv("INSTASTAGE_MAX_CONCURRENCY", "4"))
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+class TierPolicy:
+    def __init__(self, weight: int, max_concurrency: int, max_queue: int):
+        self.weight = max(1, weight)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+
+
+def default_policies(capacity: int = MAX_CONCURRENCY) -> Dict[str, TierPolicy]:
+    """Per-tier defaults, each overridable with INSTASTAGE_TIER_<TIER>_{WEIGHT,CAP,QUEUE}."""
+    defaults = {
+        "pro": (4, capacity, 64),
+        "free": (1, max(1, capacity // 2), 8),
+    }
+    return {
+        tier: TierPolicy(
+            weight=_env_int(f"INSTASTAGE_TIER_{tier.upper()}_WEIGHT", w),
+            max_concurrency=_env_int(f"INSTASTAGE_TIER_{tier.upper()}_CAP", cap),
+            max_queue=_env_int(f"INSTASTAGE_TIER_{tier.upper()}_QUEUE", q),
+        )
+        for tier, (w, cap, q) in defaults.items()
+    }
+
+
+class Overloaded(Exception):
+    """Raised by acquire() when the tier's queue is full; callers answer 503 + Retry-After."""
+
+    def __init__(self, tier: str, retry_after: int):
+        super().__init__(f"{tier} queue is full")
+        self.tier = tier
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Granted slots; hand them back with AdmissionScheduler.release()."""
+
+    __slots__ = ("tier", "started", "cost")
+
+    def __init__(self, tier: str, started: Optional[float], cost: int = 1):
+        self.tier = tier
+        self.started = started
+        self.cost = cost
+
+
+class AdmissionScheduler:
+    """
+    Admission control for staging work (the scarce resource is concurrent model calls).
+
+    - A job costs one slot per concurrent model call it makes (e.g. one per style).
+      At most `capacity` slots are in use at once, and at most `max_concurrency` per tier.
+    - Waiting jobs sit in per-tier FIFO queues; when slots free up, the backlogged tier
+      with the least weighted service (slots served / weight) goes next, so paid traffic
+      gets `weight` times the model share without starving free traffic.
+    - While anyone is waiting, nobody skips the line: the chosen job keeps the freed
+      slots until its whole cost fits, so cheap jobs can't starve a multi-slot one.
+    - A tier whose queue is at `max_queue` is shed immediately with a Retry-After hint.
+
+    Single event loop only (no locking).
+    """
+
+    def __init__(self, capacity: int = MAX_CONCURRENCY, policies: Dict[str, TierPolicy] = None):
+        self.capacity = max(1, capacity)
+        self.policies = policies or default_policies(self.capacity)
+        self._queues: Dict[str, Deque[Tuple[asyncio.Future, int]]] = {t: deque() for t in self.policies}
+        self._running: Dict[str, int] = {t: 0 for t in self.policies}
+        self._served: Dict[str, float] = {t: 0.0 for t in self.policies}
+        self._in_flight = 0
+        self._service_s = 60.0  # EWMA of job duration, seeds Retry-After
+
+    def tier_for(self, tier: str) -> str:
+        t = (tier or "").strip().lower()
+        t = _TIER_ALIASES.get(t, t)
+        return t if t in self.policies else DEFAULT_TIER
+
+    def _fits(self, tier: str, cost: int) -> bool:
+        return (
+            self._in_flight + cost <= self.capacity
+            and self._running[tier] + cost <= self.policies[tier].max_concurrency
+        )
+
+    def _cost(self, tier: str, cost: int) -> int:
+        """Clamp so a large job can still be granted once its tier and the pool are idle."""
+        return max(1, min(cost, self.capacity, self.policies[tier].max_concurrency))
+
+    def _vtime(self) -> float:
+        active = [self._served[t] for t in self.policies if self._queues[t] or self._running[t]]
+        return min(active) if active else 0.0
+
+    def _grant(self, tier: str, cost: int) -> None:
+        self._running[tier] += cost
+        self._in_flight += cost
+        self._served[tier] += cost / self.policies[tier].weight
+
+    def _dispatch(self) -> None:
+        while True:
+            for q in self._queues.values():
+                while q and q[0][0].done():  # waiters that went away
+                    q.popleft()
+            # Tiers whose head job is within the tier's own cap, in weighted order
+            backlogged = [
+                t for t in self.policies
+                if self._queues[t]
+                and self._running[t] + self._queues[t][0][1] <= self.policies[t].max_concurrency
+            ]
+            if not backlogged:
+                return
+            tier = min(backlogged, key=lambda t: (self._served[t], -self.policies[t].weight))
+            fut, cost = self._queues[tier][0]
+            if self._in_flight + cost > self.capacity:
+                return  # hold the free slots for it until enough work drains
+            self._queues[tier].popleft()
+            self._grant(tier, cost)
+            fut.set_result(None)
+
+    def retry_after(self, tier: str) -> int:
+        """Rough seconds until a newly queued `tier` job would start."""
+        pol = self.policies[tier]
+        depth = len(self._queues[tier]) + 1
+        return int(min(120, max(1, math.ceil(depth * self._service_s / pol.max_concurrency))))
+
+    async def acquire(self, tier: str, cost: int = 1) -> Ticket:
+        """Wait for `cost` slots (raises Overloaded if the tier's queue is full)."""
+        tier = self.tier_for(tier)
+        cost = self._cost(tier, cost)
+        start = time.monotonic()
+
+        if self._fits(tier, cost) and not any(self._queues.values()):
+            if not self._running[tier]:
+                self._served[tier] = max(self._served[tier], self._vtime())
+            self._grant(tier, cost)
+        else:
+            queue = self._queues[tier]
+            if len(queue) >= self.policies[tier].max_queue:
+                metrics.incr(f"admission.shed.{tier}")
+                raise Overloaded(tier, self.retry_after(tier))
+            if not queue and not self._running[tier]:
+                # Newly backlogged tier starts at the current virtual time (no banked credit)
+                self._served[tier] = max(self._served[tier], self._vtime())
+            fut = asyncio.get_running_loop().create_future()
+            entry = (fut, cost)
+            queue.append(entry)
+            self._dispatch()  # may be granted right away if it is next in line
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Slots were granted just as the caller went away: hand them back
+                    self.release(Ticket(tier, None, cost))
+                elif entry in queue:
+                    queue.remove(entry)
+                    self._dispatch()  # a smaller job behind it may fit now
+                raise
+
+        now = time.monotonic()
+        metrics.incr(f"admission.admitted.{tier}")
+        metrics.observe(f"admission.wait.{tier}", now - start)
+        return Ticket(tier, now, cost)
+
+    def try_acquire(self, tier: str, cost: int = 1) -> Optional[Ticket]:
+        """`cost` slots right now if they are free and nobody is waiting, else None."""
+        tier = self.tier_for(tier)
+        if any(self._queues.values()) or not self._fits(tier, cost):
+            return None
+        self._grant(tier, cost)
+        return Ticket(tier, None, cost)
+
+    def release(self, ticket: Ticket) -> None:
+        self._running[ticket.tier] -= ticket.cost
+        self._in_flight -= ticket.cost
+        if ticket.started is not None:
+            self._service_s = 0.8 * self._service_s + 0.2 * (time.monotonic() - ticket.started)
+        self._dispatch()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_flight": self._in_flight,
+            "tiers": {
+                t: {"running": self._running[t], "queued": len(self._queues[t])}
+                for t in self.policies
+            },
+        }
+
+
+# The admitted job running in this task context; model-call tasks it spawns inherit it.
+_current: "ContextVar[Optional[Tuple[AdmissionScheduler, Ticket]]]" = ContextVar("admission_ticket", default=None)
+
+
+def bind(scheduler: AdmissionScheduler, ticket: Ticket) -> None:
+    _current.set((scheduler, ticket))
+
+
+def borrow_slot() -> Optional[Callable[[], None]]:
+    """
+    One extra slot for the current job's tier (e.g. a hedged model call). Returns the
+    release callback, or None if no slot is free. Outside an admitted job (scripts)
+    nothing is metered and a no-op release is returned.
+    """
+    cur = _current.get()
+    if cur is None:
+        return lambda: None
+    scheduler, ticket = cur
+    extra = scheduler.try_acquire(ticket.tier)
+    if extra is None:
+        return None
+    return lambda: scheduler.release(extra)
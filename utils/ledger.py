@@ -0,0 +1,216 @@
+# utils/ledger.py
+import base64
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import metrics
+
+# Default lives on render.yaml's persistent disk (mounted at ./media) so history survives
+# deploys. media/ is not served statically; if it ever is, keep _ledger/ out of it.
+LEDGER_PATH = os.getenv("INSTASTAGE_LEDGER_PATH", os.path.join("media", "_ledger", "jobs.sqlite3"))
+# Signs history tokens. Set it in production: the random fallback invalidates every
+# issued token (and so the history behind it) on restart.
+HISTORY_SECRET = os.getenv("INSTASTAGE_HISTORY_SECRET", "").encode() or secrets.token_bytes(32)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY,
+    job_id      TEXT NOT NULL,
+    owner       TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    kind        TEXT NOT NULL,
+    room_type   TEXT,
+    tier        TEXT,
+    original_key TEXT NOT NULL,
+    variants    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_owner_created ON jobs (owner, created_at, id);
+CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id);
+"""
+
+_COLUMNS = ("job_id", "owner", "created_at", "kind", "room_type", "tier", "original_key", "variants")
+_BATCH = 256
+_RECENT_OWNERS = 4096  # job owners kept in memory until their rows are surely written
+
+
+def encode_cursor(created_at: float, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at!r}:{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Raises ValueError on a malformed cursor."""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, row_id = raw.split(":", 1)
+    return float(created_at), int(row_id)
+
+
+def _sign_owner(owner: str) -> str:
+    mac = hmac.new(HISTORY_SECRET, owner.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
+
+def issue_owner_token() -> Tuple[str, str]:
+    """A new server-chosen owner id and the bearer token ("<owner>.<hmac>") proving it."""
+    owner = uuid.uuid4().hex
+    return owner, f"{owner}.{_sign_owner(owner)}"
+
+
+def owner_from_token(token: Optional[str]) -> Optional[str]:
+    """The owner a history token was issued for, or None if it is missing or forged."""
+    owner, _, sig = (token or "").strip().partition(".")
+    if owner and sig and hmac.compare_digest(sig, _sign_owner(owner)):
+        return owner
+    return None
+
+
+class JobLedger:
+    """
+    Append-only job history in SQLite (WAL). record() only enqueues; a single writer
+    thread batches inserts, so the request path never waits on disk. Rows hold storage
+    keys, never presigned URLs (those expire); callers re-sign on read.
+    """
+
+    def __init__(self, path: str = LEDGER_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+        self._owners: "OrderedDict[str, str]" = OrderedDict()
+        self._owners_lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._local = threading.local()
+        self._writer = threading.Thread(target=self._write_loop, name="job-ledger", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(
+        self,
+        job_id: str,
+        owner: str,
+        kind: str,
+        room_type: str,
+        tier: str,
+        original_key: str,
+        variants: List[Dict[str, str]],
+    ) -> None:
+        """Queue one job row; variants = [{furniture_style, staged_key}]."""
+        self.claim(job_id, owner)
+        self._queue.put({
+            "job_id": job_id,
+            "owner": owner,
+            "created_at": time.time(),
+            "kind": kind,
+            "room_type": room_type,
+            "tier": tier,
+            "original_key": original_key,
+            "variants": json.dumps(variants, separators=(",", ":")),
+        })
+
+    def claim(self, job_id: str, owner: str) -> None:
+        """Remember who owns `job_id` before its row lands (inline responses write later)."""
+        with self._owners_lock:
+            self._owners.setdefault(job_id, owner)
+            self._owners.move_to_end(job_id)
+            while len(self._owners) > _RECENT_OWNERS:
+                self._owners.popitem(last=False)
+
+    def owner_of(self, job_id: str) -> Optional[str]:
+        """Owner of the job's first row (its /stage), or None for an unknown job."""
+        with self._owners_lock:
+            owner = self._owners.get(job_id)
+        if owner is not None:
+            return owner
+        row = self._reader().execute(
+            "SELECT owner FROM jobs WHERE job_id = ? ORDER BY id LIMIT 1", (job_id,)
+        ).fetchone()
+        return row["owner"] if row is not None else None
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        sql = f"INSERT INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})"
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < _BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = [r for r in batch if r is not None]
+            if not batch:
+                continue
+            try:
+                with conn:
+                    conn.executemany(sql, [tuple(r[c] for c in _COLUMNS) for r in batch])
+                metrics.incr("ledger.rows_written", len(batch))
+            except sqlite3.Error:
+                metrics.incr("ledger.write_errors", len(batch))
+        conn.close()
+
+    def list_jobs(self, owner: str, limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Newest-first page of `owner`'s jobs. Keyset pagination on (created_at, id), so
+        every page is an index range scan regardless of how deep the cursor is.
+        """
+        params: List[Any] = [owner]
+        where = "owner = ?"
+        if cursor:
+            created_at, row_id = decode_cursor(cursor)
+            where += " AND (created_at, id) < (?, ?)"
+            params += [created_at, row_id]
+        params.append(limit + 1)
+        rows = self._reader().execute(
+            f"SELECT * FROM jobs WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+            params,
+        ).fetchall()
+
+        jobs = [
+            {
+                "job_id": r["job_id"],
+                "kind": r["kind"],
+                "created_at": r["created_at"],
+                "room_type": r["room_type"],
+                "tier": r["tier"],
+                "original_key": r["original_key"],
+                "variants": json.loads(r["variants"]),
+            }
+            for r in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        return jobs, next_cursor
+
+    def close(self) -> None:
+        """Flush queued rows and stop the writer thread."""
+        self._queue.put(None)
+        self._writer.join(timeout=10)
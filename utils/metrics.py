@@ -0,0 +1,50 @@
+# utils/metrics.py
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Optional
+
+# Process-local counters and timers, exposed as JSON by GET /metrics.
+_lock = threading.Lock()
+_counters: Dict[str, int] = defaultdict(int)
+_timers: Dict[str, Dict[str, Any]] = {}
+_WINDOW = 512  # recent samples kept per timer for percentiles
+
+
+def incr(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        t = _timers.get(name)
+        if t is None:
+            t = _timers[name] = {"count": 0, "sum": 0.0, "max": 0.0, "recent": deque(maxlen=_WINDOW)}
+        t["count"] += 1
+        t["sum"] += seconds
+        t["max"] = max(t["max"], seconds)
+        t["recent"].append(seconds)
+
+
+def percentile(samples: Deque[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        timers = {
+            name: {
+                "count": t["count"],
+                "mean": t["sum"] / t["count"] if t["count"] else 0.0,
+                "p50": percentile(t["recent"], 50),
+                "p95": percentile(t["recent"], 95),
+                "p99": percentile(t["recent"], 99),
+                "max": t["max"],
+            }
+            for name, t in _timers.items()
+        }
+        return {"counters": dict(_counters), "timers": timers}
@@ -18,6 +18,17 @@ class Storage:
         """Save and return a fetchable URL."""
         raise NotImplementedError
 
+    def load_bytes(self, key: str) -> bytes:
+        """Return the stored bytes; raises FileNotFoundError if the key doesn't exist."""
+        raise NotImplementedError
+
+    def url_for(self, key: str) -> str:
+        """Fetchable URL for an already stored key."""
+        raise NotImplementedError
+
+    def warm(self) -> None:
+        """Build clients/connections ahead of the first request (startup warm-up)."""
+
 class LocalStorage(Storage):
     def __init__(self, root: str = "media"):
         self.root = root
@@ -27,12 +38,29 @@ class LocalStorage(Storage):
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, "wb") as f:
             f.write(data)
+        return self.url_for(key)
+
+    def load_bytes(self, key: str) -> bytes:
+        with open(os.path.join(self.root, key), "rb") as f:
+            return f.read()
+
+    def url_for(self, key: str) -> str:
         return f"{PUBLIC_BASE_URL.rstrip('/')}/media/{key}"
 
 class S3Storage(Storage):
     def __init__(self):
-        import boto3  # ensure boto3 in requirements
-        self.s3 = boto3.client("s3", region_name=REGION)
+        # boto3 is slow to import and build; defer it so importing main stays cheap
+        self._s3 = None
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            import boto3  # ensure boto3 in requirements
+            self._s3 = boto3.client("s3", region_name=REGION)
+        return self._s3
+
+    def warm(self) -> None:
+        self.s3
 
     def save_bytes(self, key: str, data: bytes, content_type: str | None = None) -> str:
         ct = content_type or _guess_content_type(key)
@@ -40,6 +68,16 @@ class S3Storage(Storage):
         if PUBLIC_READ:
             extra["ACL"] = "public-read"
         self.s3.put_object(Bucket=BUCKET, Key=key, Body=data, **extra)
+        return self.url_for(key)
+
+    def load_bytes(self, key: str) -> bytes:
+        try:
+            obj = self.s3.get_object(Bucket=BUCKET, Key=key)
+        except self.s3.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+        return obj["Body"].read()
+
+    def url_for(self, key: str) -> str:
         if PUBLIC_READ:
             # public object URL
             # For us-east-1 (classic), both forms work; this one is region-less:
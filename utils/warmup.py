@@ -0,0 +1,70 @@
+# utils/warmup.py
+import asyncio
+import importlib
+import os
+import time
+from typing import Any, Dict, List
+
+from utils import metrics
+
+# Comma-separated steps run at startup; "rembg" is opt-in (loads the onnx model, ~seconds).
+DEFAULT_STEPS = "pipeline,storage,http"
+OPENAI_MODELS_URL = "https://api.openai.com/v1/models"
+
+
+def configured_steps() -> List[str]:
+    raw = os.getenv("INSTASTAGE_WARMUP", DEFAULT_STEPS)
+    return [s.strip().lower() for s in raw.split(",") if s.strip()]
+
+
+class Warmup:
+    """
+    Startup warm-up run in the background from the app lifespan, so the port opens
+    immediately while GET /ready stays 503 until every step has been attempted.
+    """
+
+    def __init__(self, storage, steps: List[str] = None):
+        self.storage = storage
+        self.steps = configured_steps() if steps is None else steps
+        self.ready = False
+        self.status: Dict[str, Any] = {}
+
+    async def _pipeline(self) -> None:
+        # /stage imports the pipeline lazily; pay that on boot instead of on the first request
+        await asyncio.to_thread(importlib.import_module, "staging.pipeline")
+
+    async def _storage(self) -> None:
+        await asyncio.to_thread(self.storage.warm)
+
+    async def _http(self) -> None:
+        from staging.http_client import get_client
+
+        client = get_client()
+        key = os.getenv("OPENAI_API_KEY", "").strip()
+        if key:
+            # Any response will do: it leaves a TLS connection to api.openai.com in the pool
+            await client.get(OPENAI_MODELS_URL, headers={"Authorization": f"Bearer {key}"}, timeout=10)
+
+    async def _rembg(self) -> None:
+        from staging.generator_openai import rembg_session
+
+        await asyncio.to_thread(rembg_session)
+
+    async def run(self) -> None:
+        for step in self.steps:
+            fn = getattr(self, f"_{step}", None)
+            if fn is None:
+                self.status[step] = {"ok": False, "error": "unknown warm-up step"}
+                continue
+            t0 = time.monotonic()
+            try:
+                await fn()
+                self.status[step] = {"ok": True}
+            except Exception as e:
+                # A failed optional step shouldn't keep the instance out of rotation forever
+                self.status[step] = {"ok": False, "error": str(e)[:200]}
+                metrics.incr(f"warmup.{step}.errors")
+            elapsed = time.monotonic() - t0
+            self.status[step]["seconds"] = round(elapsed, 3)
+            metrics.observe(f"warmup.{step}", elapsed)
+        self.ready = True